@@ -0,0 +1,61 @@
+'''
+Compares the regular msgpack encoding of RPC calls with the
+schema based compact encoding (see APISchema). Reports the
+bytes on the wire (request + response) and the CPU time spent
+in encoding and decoding (client + server) per call.
+
+    python examples/bench_compact_encoding.py --calls 100000
+'''
+
+import argparse
+import resource
+
+import msgpack
+from funcserver import APISchema
+
+from calc_rpc_server import CalcAPI
+
+def cpu_time():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+def plain_call(fn, args, kwargs, result):
+    req = msgpack.packb(dict(fn=fn, args=args, kwargs=kwargs))
+    msgpack.unpackb(req)
+    res = msgpack.packb({'success': True, 'result': result})
+    msgpack.unpackb(res)
+    return len(req) + len(res)
+
+def compact_call(schema, fn, args, kwargs, result):
+    req = schema.encode_call(fn, args, kwargs)
+    schema.decode_call(req)
+    res = APISchema.encode_result({'success': True, 'result': result})
+    APISchema.decode_result(res)
+    return len(req) + len(res)
+
+def bench(name, fn, calls):
+    nbytes = 0
+    t = cpu_time()
+    for i in xrange(calls):
+        nbytes += fn(i)
+    t = cpu_time() - t
+
+    print '%-8s %8.1f bytes/call %8.2f us/call' % \
+        (name, float(nbytes) / calls, t * 1e6 / calls)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=100000)
+    args = parser.parse_args()
+
+    schema = APISchema.from_api(CalcAPI())
+
+    # the schema is fetched once by each client
+    print 'schema   %8d bytes (once)' % len(msgpack.packb(schema.to_dict()))
+
+    bench('msgpack', lambda i: plain_call('add', (i, 20), {}, i + 20), args.calls)
+    bench('compact', lambda i: compact_call(schema, 'add', (i, 20), {}, i + 20), args.calls)
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,3 @@
 from funcserver import FuncServer, RPCServer, BaseHandler, RPCClient, BaseScript, StatsCollector
-from funcserver import make_handler, tag, mime, raw
+from funcserver import RPCEndpointPool, RPCCallException, APISchema
+from funcserver import make_handler, tag, mime, raw, idempotent, singleflight, cacheable
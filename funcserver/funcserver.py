@@ -6,33 +6,61 @@ import sys
 import json
 import time
 import code
+import signal
+import ctypes
 import socket
+import random
+import hashlib
+import datetime
+import email.utils
 import inspect
 import logging
+import logging.handlers
+import repr as reprlib
 import msgpack
-import cStringIO
+import httplib
 import urlparse
 import argparse
 import resource
 import traceback
 import threading
 from ast import literal_eval
+from collections import deque, Counter, OrderedDict
 
 import gevent
+import gevent.event
+import gevent.queue
+import gevent.threadpool
+from gevent.monkey import get_original
 import requests
 import statsd
 import tornado.ioloop
 import tornado.web
 import tornado.websocket
 import tornado.iostream
+import tornado.concurrent
 from tornado.template import BaseLoader, Template
 from tornado.web import StaticFileHandler, HTTPError
 
+# optional. python 3.4+ or the pytracemalloc package
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 MSG_TYPE_CONSOLE = 0
 MSG_TYPE_LOG = 1
 
 MAX_LOG_FILE_SIZE = 100 * 1024 * 1024 # 100MB
 
+# limited repr of call args for logging exceptions
+LOG_REPR = reprlib.Repr()
+LOG_REPR.maxstring = LOG_REPR.maxother = 256
+
+# identifies the real OS thread even when threading is
+# monkey patched (console evaluation uses real threads)
+get_thread_ident = get_original('thread', 'get_ident')
+
 # set the logging level of requests module to warning
 # otherwise it swamps with too many logs
 logging.getLogger('requests').setLevel(logging.WARNING)
@@ -77,6 +105,34 @@ def raw(mime='application/octet-stream'):
         return fn
     return dfn
 
+def idempotent(fn):
+    '''
+    Marks the fn as safe to be executed more than once
+    for the same request. RPCClient retries a failed call
+    on a different server only if the fn is idempotent.
+    '''
+    return tag('idempotent')(fn)
+
+def cacheable(max_age=60):
+    '''
+    Constructs a decorator that marks the fn's result as
+    cacheable by browsers and proxies for @max_age seconds
+    when the fn is called using HTTP GET.
+    '''
+    def dfn(fn):
+        tag('cacheable')(fn)
+        fn.cache_max_age = max_age
+        return fn
+    return dfn
+
+def singleflight(fn):
+    '''
+    Marks the fn for single-flight execution. Concurrent calls
+    to the fn with the same arguments share one execution and
+    all of them get its result.
+    '''
+    return tag('singleflight')(fn)
+
 class RPCCallException(Exception):
     pass
 
@@ -94,6 +150,183 @@ class PyInterpreter(code.InteractiveInterpreter):
     def write(self, data):
         self.output.append(data)
 
+class ConsoleLimitExceeded(BaseException):
+    '''
+    Aborts a console evaluation. Not an Exception subclass so
+    that console code doing "except Exception" cannot swallow it.
+    '''
+    pass
+
+class ConsoleOutput(object):
+    '''
+    Replacement for sys.stdout that routes the output written
+    by a console evaluation to the session running it. Output
+    from the rest of the process goes to the original stream.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sessions = {} # thread ident -> ConsoleSession
+
+    @classmethod
+    def install(cls):
+        if not isinstance(sys.stdout, cls):
+            sys.stdout = cls(sys.stdout)
+        return sys.stdout
+
+    def write(self, data):
+        session = self.sessions.get(get_thread_ident())
+        if session is None: return self.stream.write(data)
+        session.write(data)
+
+    def flush(self):
+        if get_thread_ident() not in self.sessions:
+            self.stream.flush()
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+class ConsoleSession(object):
+    '''
+    Python console state of one websocket connection. Code is
+    evaluated in a worker thread (see FuncServer.console_pool)
+    so that a slow expression does not block the server. The
+    output is buffered here and streamed back by the connection.
+
+    gevent objects are not thread safe. Sockets, locks and pools
+    created on the ioloop thread (eg: by the api) must only be
+    used through call(fn, ...), which runs @fn on the ioloop and
+    returns its result to the console.
+
+    An evaluation is aborted when it runs longer than TIME_LIMIT
+    seconds or writes more than MAX_OUTPUT_SIZE bytes. The time
+    limit is enforced by a trace fn, on every write and by the
+    connection re-raising ConsoleLimitExceeded in the worker
+    thread (see interrupt) until the evaluation ends. Code that
+    swallows it with a bare "except:" is aborted only once an
+    interrupt lands outside the try, which can take a while. A
+    long running C level call (eg: a blocking socket read or a
+    large sort) cannot be interrupted and is aborted only when
+    it returns to python code.
+    '''
+
+    TIME_LIMIT = 30 # seconds
+    INTERRUPT_GRACE = 1 # seconds the trace fn gets to abort first
+    MAX_OUTPUT_SIZE = 1 * 1024 * 1024 # 1MB
+
+    def __init__(self, namespace):
+        self.interpreter = PyInterpreter(namespace)
+        self.interpreter.write = self.write
+        self.chunks = deque() # appended by worker, consumed by reader
+        self.nbytes = 0
+        self.truncated = False
+        self.expired = False
+        self.deadline = None
+        self.busy = False
+
+        # worker thread running the evaluation. guarded by a real
+        # lock as interrupt is called from the ioloop thread.
+        self.ident = None
+        self.ident_lock = get_original('thread', 'allocate_lock')()
+
+    def _check_deadline(self):
+        # raised once here so that the traceback can be written
+        if not self.expired and time.time() > self.deadline:
+            self.expired = True
+            raise ConsoleLimitExceeded('time limit of %ss exceeded' % self.TIME_LIMIT)
+
+    def write(self, data):
+        self._check_deadline()
+        if self.truncated: return
+
+        self.nbytes += len(data)
+        if self.nbytes > self.MAX_OUTPUT_SIZE:
+            self.truncated = True
+            self.chunks.append('\n[output truncated at %d bytes]\n' % self.MAX_OUTPUT_SIZE)
+            raise ConsoleLimitExceeded('output size limit exceeded')
+
+        self.chunks.append(data)
+
+    def read(self, complete_lines=False):
+        '''
+        Returns the output buffered so far. With @complete_lines
+        a trailing partial line is left in the buffer.
+        '''
+        data = []
+        while self.chunks: data.append(self.chunks.popleft())
+        data = ''.join(data)
+
+        if complete_lines:
+            idx = data.rfind('\n') + 1
+            if idx < len(data): self.chunks.appendleft(data[idx:])
+            data = data[:idx]
+
+        return data
+
+    def _trace(self, frame, event, arg):
+        # the trace fn is unset by python on raising. interrupt
+        # takes over if the exception gets swallowed.
+        self._check_deadline()
+        return self._trace
+
+    def interrupt(self):
+        '''
+        Raises ConsoleLimitExceeded asynchronously in the worker
+        thread if the evaluation is past its deadline (plus a grace
+        period to let the trace fn abort it with a traceback).
+        Called periodically by the connection till it ends.
+        '''
+        with self.ident_lock:
+            if self.ident is None: return
+            if time.time() <= self.deadline + self.INTERRUPT_GRACE: return
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self.ident),
+                ctypes.py_object(ConsoleLimitExceeded))
+
+    def _disarm(self, output):
+        with self.ident_lock:
+            sys.settrace(None)
+            output.sessions.pop(self.ident, None)
+
+            # clear an interrupt that is pending but not yet raised
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self.ident), None)
+            self.ident = None
+
+    def run(self, code):
+        '''
+        Evaluates @code. This is run in a worker thread.
+        '''
+        output = ConsoleOutput.install()
+
+        self.nbytes = 0
+        self.truncated = False
+        self.expired = False
+        self.deadline = time.time() + self.TIME_LIMIT
+
+        with self.ident_lock:
+            self.ident = get_thread_ident()
+            output.sessions[self.ident] = self
+
+        try:
+            try:
+                sys.settrace(self._trace)
+                self.interpreter.runsource(code)
+            finally:
+                self._disarm(output)
+        except ConsoleLimitExceeded:
+            # an interrupt can land during _disarm itself
+            while self.ident is not None:
+                try:
+                    self._disarm(output)
+                except ConsoleLimitExceeded:
+                    pass
+
+class PingHandler(BaseHandler):
+    '''
+    Cheap liveness check used by RPCClient health probes
+    '''
+    def get(self):
+        self.write('pong')
+
 class WSConnection(tornado.websocket.WebSocketHandler):
     '''
     Websocket based communication channel between a
@@ -101,6 +334,7 @@ class WSConnection(tornado.websocket.WebSocketHandler):
     '''
 
     WRITE_BUFFER_THRESHOLD = 1 * 1024 * 1024 # 1MB
+    CONSOLE_FLUSH_INTERVAL = 0.2 # seconds
 
     def open(self):
         '''
@@ -128,23 +362,38 @@ class WSConnection(tornado.websocket.WebSocketHandler):
 
         msg = json.loads(msg)
 
-        interpreter = self.state.get('interpreter', None)
-        if interpreter is None:
-            interpreter = PyInterpreter(self.funcserver.define_python_namespace())
-            self.state['interpreter'] = interpreter
+        session = self.state.get('console', None)
+        if session is None:
+            session = ConsoleSession(self.funcserver.define_python_namespace())
+            self.state['console'] = session
 
-        code = msg['code']
-        msg_id = msg['id']
+        if session.busy:
+            self.send_message({'type': MSG_TYPE_CONSOLE, 'id': msg['id'],
+                'data': 'previous command is still running'})
+            return
 
-        stdout = sys.stdout
+        session.busy = True
+        gevent.spawn(self._run_console, session, msg['code'], msg['id'])
+
+    def _run_console(self, session, code, msg_id):
+        '''
+        Runs @code in a console worker thread and streams the
+        output back as it is produced. Partial messages are
+        followed by a final one that completes the command.
+        '''
         try:
-            sys.stdout = cStringIO.StringIO()
-            interpreter.runsource(code)
-            output = sys.stdout.getvalue() or interpreter.output
-            if isinstance(output, list): output = ''.join(output)
-            interpreter.output = []
+            job = self.funcserver.console_pool.spawn(session.run, code)
+            while not job.ready():
+                job.wait(self.CONSOLE_FLUSH_INTERVAL)
+                session.interrupt()
+                data = session.read(complete_lines=True)
+                if data:
+                    self.send_message({'type': MSG_TYPE_CONSOLE, 'id': msg_id,
+                        'data': data, 'partial': True})
+
+            output = session.read()
         finally:
-            sys.stdout = stdout
+            session.busy = False
 
         msg = {'type': MSG_TYPE_CONSOLE, 'id': msg_id, 'data': output}
         self.send_message(msg)
@@ -182,9 +431,49 @@ class WSConnection(tornado.websocket.WebSocketHandler):
         return {'type': msg.get('type', ''), 'id': msg['id']}
 
 
-def call(fn):
+CALL_POLL_INTERVAL = 0.01 # seconds
+
+def call(fn, *args, **kwargs):
+    '''
+    Runs @fn on the ioloop thread. From the ioloop thread itself
+    it is only scheduled (see "Debugging using PDB" in README).
+
+    Console code runs in a worker thread where the gevent objects
+    of the server (sockets, locks, connection pools of the api)
+    cannot be used. From there, @fn is run in a greenlet on the
+    ioloop and call waits for it to return its result or raise
+    its exception. The wait is subject to the console time limit
+    but @fn itself keeps running if the wait is aborted.
+    '''
     ioloop = tornado.ioloop.IOLoop.instance()
-    ioloop.add_callback(fn)
+    funcserver = getattr(sys, 'funcserver', None)
+    if funcserver is None or get_thread_ident() == funcserver.thread_ident:
+        ioloop.add_callback(fn, *args, **kwargs)
+        return
+
+    done = get_original('thread', 'allocate_lock')()
+    done.acquire()
+    result = []
+
+    def run():
+        try:
+            result.append((True, fn(*args, **kwargs)))
+        except BaseException:
+            result.append((False, sys.exc_info()))
+        finally:
+            done.release()
+
+    # add_callback is the only ioloop method safe to use from
+    # another thread
+    ioloop.add_callback(gevent.spawn, run)
+
+    # polled so that the console time limit can abort the wait
+    sleep = get_original('time', 'sleep')
+    while not done.acquire(False): sleep(CALL_POLL_INTERVAL)
+
+    ok, r = result[0]
+    if ok: return r
+    raise r[0], r[1], r[2]
 
 
 def make_handler(template, handler):
@@ -199,15 +488,203 @@ def resolve_path(path):
     return path if os.path.isabs(path) else os.path.join(os.path.dirname(__file__), path)
 
 
-class WebLogHandler(logging.Handler):
+class LimitedLogHandler(logging.Handler):
+    '''
+    Base for handlers that must stay cheap during a burst of
+    errors. Exceptions logged from the same place (and for the
+    same RPC function) are limited to EXC_RATE_LIMIT per
+    EXC_RATE_WINDOW seconds and messages and tracebacks are capped
+    at MAX_RECORD_SIZE. Handlers call _limit from emit.
+    '''
+
+    MAX_RECORD_SIZE = 64 * 1024
+    EXC_RATE_LIMIT = 10
+    EXC_RATE_WINDOW = 60 # seconds
+    MAX_EXC_KEYS = 1000
+
+    def __init__(self):
+        super(LimitedLogHandler, self).__init__()
+        self.exc_counts = OrderedDict() # key -> [window start, count, suppressed]
+        self.exc_formatter = logging.Formatter()
+
+    def _limit(self, record):
+        '''
+        Returns a copy of @record prepared for formatting (see
+        _prepare) or None if it is to be dropped. Other handlers of
+        the logger still see the original args and exc_info.
+        '''
+        record = logging.makeLogRecord(record.__dict__)
+        if record.exc_info and not self._allow_exception(record):
+            return None
+
+        self._prepare(record)
+        return record
+
+    def _allow_exception(self, record):
+        # a single log call can report failures of many RPC
+        # functions (see RPCHandler._execute_single_call)
+        key = (record.pathname, record.lineno, record.exc_info[0],
+                getattr(record, 'rpc_fn', None))
+        c = self.exc_counts.get(key)
+
+        if c is None or record.created - c[0] >= self.EXC_RATE_WINDOW:
+            # keys are kept in the order their windows started and the
+            # oldest is evicted so that a burst of new keys does not
+            # reset the limits of all the others
+            if c is not None:
+                del self.exc_counts[key]
+            elif len(self.exc_counts) >= self.MAX_EXC_KEYS:
+                self.exc_counts.popitem(last=False)
+
+            record.suppressed = c[2] if c else 0
+            self.exc_counts[key] = [record.created, 1, 0]
+            return True
+
+        if c[1] < self.EXC_RATE_LIMIT:
+            c[1] += 1
+            return True
+
+        c[2] += 1
+        return False
+
+    def _truncate(self, text):
+        if len(text) <= self.MAX_RECORD_SIZE: return text
+        return text[:self.MAX_RECORD_SIZE] + ' ... [truncated]'
+
+    def _prepare(self, record):
+        '''
+        Makes the record safe to be formatted later in another
+        thread. The message is rendered and the traceback is
+        turned into text so that no references to args and
+        frames are held.
+        '''
+        msg = self._truncate(record.getMessage())
+
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            msg += ' [%d similar exceptions suppressed]' % suppressed
+
+        record.msg = msg
+        record.args = None
+
+        if record.exc_info:
+            exc_text = self.exc_formatter.formatException(record.exc_info)
+            record.exc_text = self._truncate(exc_text)
+            record.exc_info = None
+
+class WebLogHandler(LimitedLogHandler):
     def __init__(self, funcserver):
         super(WebLogHandler, self).__init__()
         self.funcserver = funcserver
 
     def emit(self, record):
-        msg = self.format(record)
-        self.funcserver._send_log(msg)
+        # nothing to format when the logs are not being watched
+        if not self.funcserver.websocks: return
+
+        try:
+            record = self._limit(record)
+            if record is None: return
+            msg = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        # websockets can only be written to from the ioloop thread
+        if get_thread_ident() == self.funcserver.thread_ident:
+            self.funcserver._send_log(msg)
+        else:
+            ioloop = tornado.ioloop.IOLoop.instance()
+            ioloop.add_callback(self.funcserver._send_log, msg)
+
+
+class AsyncLogHandler(LimitedLogHandler):
+    '''
+    Queues log records for a background thread that writes them
+    in batches to the @targets handlers (eg: rotating file, stderr)
+    so that logging does not wait on the disk. File rotation also
+    happens in the background thread.
+
+    When MAX_QUEUE_SIZE records are pending, new records are
+    dropped and counted. Exceptions and large records are limited
+    as described in LimitedLogHandler.
+    '''
+
+    FLUSH_INTERVAL = 0.1 # seconds
+    MAX_QUEUE_SIZE = 10000
+
+    def __init__(self, targets):
+        super(AsyncLogHandler, self).__init__()
+        self.targets = targets
+        self.queue = deque()
+        self.dropped = 0
+
+        # real thread primitives as the writer is not a greenlet
+        self.write_lock = get_original('thread', 'allocate_lock')()
+        self.running = True
+        get_original('thread', 'start_new_thread')(self._run, ())
+
+    def emit(self, record):
+        if len(self.queue) >= self.MAX_QUEUE_SIZE:
+            self.dropped += 1
+            return
+
+        try:
+            record = self._limit(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        if record is not None: self.queue.append(record)
+
+    def _run(self):
+        sleep = get_original('time', 'sleep')
+        while self.running:
+            sleep(self.FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        with self.write_lock:
+            records = []
+            while self.queue: records.append(self.queue.popleft())
+
+            if self.dropped:
+                n, self.dropped = self.dropped, 0
+                records.append(logging.makeLogRecord({'levelno': logging.WARNING,
+                    'levelname': 'WARNING', 'msg': 'log queue full. dropped %d records' % n}))
 
+            if not records: return
+            for target in self.targets:
+                self._write(target, records)
+
+    def _write(self, target, records):
+        if not isinstance(target, logging.StreamHandler):
+            for record in records: target.handle(record)
+            return
+
+        # write the batch with a single flush instead of
+        # the per record flush done by StreamHandler.emit
+        rotating = isinstance(target, logging.handlers.RotatingFileHandler)
+        try:
+            for record in records:
+                if record.levelno < target.level: continue
+
+                msg = target.format(record) + '\n'
+                if isinstance(msg, unicode): msg = msg.encode('utf-8')
+
+                if rotating and target.maxBytes > 0 and \
+                    target.stream.tell() + len(msg) >= target.maxBytes:
+                    target.doRollover()
+
+                target.stream.write(msg)
+            target.flush()
+        except Exception:
+            self.handleError(records[-1])
+
+    def close(self):
+        self.running = False
+        self.flush()
+        for target in self.targets: target.close()
+        super(AsyncLogHandler, self).close()
 
 class TemplateLoader(BaseLoader):
     def __init__(self, dirs=None, **kwargs):
@@ -288,6 +765,7 @@ class StatsCollector(object):
             while 1:
                 time.sleep(self.STATS_FLUSH_INTERVAL)
                 self._collect_ramusage()
+                self._collect_gcstats()
                 self.send()
 
         self.stats_thread = gevent.spawn(fn)
@@ -314,6 +792,10 @@ class StatsCollector(object):
         self.gauge('resource.maxrss',
             resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
 
+    def _collect_gcstats(self):
+        for gen, n in enumerate(gc.get_count()):
+            self.gauge('gc.count.gen%d' % gen, n)
+
     def send(self):
         if self.stats is None: return
         p = self.stats.pipeline()
@@ -328,6 +810,339 @@ class StatsCollector(object):
         self.cache = {}
         self.gauge_cache = {}
 
+class MemoryDiagnostics(object):
+    '''
+    Tools to find out why the memory usage of a long running
+    process grows. Available from the Memory tab of the web UI,
+    over HTTP at /memory/<action> and as server.memory in the
+    python console.
+
+    tracemalloc based features (snapshots, diffs and allocations
+    per API fn) need python 3.4+ or the pytracemalloc package.
+
+    Allocations per API fn are measured for @sample_rate fraction
+    of the calls. When tracing has not been started explicitly
+    (start or --trace-memory), it is switched on only while sampled
+    calls are running, so the overhead is paid by those calls
+    alone. When it has been started, every allocation is traced
+    and only the per fn bookkeeping is sampled. As calls run
+    concurrently in greenlets, a sample can include allocations
+    made by other calls during that time.
+    '''
+
+    SAMPLE_RATE = 0.01
+    NFRAMES = 1 # frames of traceback stored per allocation
+
+    def __init__(self, sample_rate=None):
+        self.sample_rate = self.SAMPLE_RATE if sample_rate is None else sample_rate
+        self.last_snapshot = None
+        self.fn_allocs = {} # fn name -> [sampled calls, total bytes, max bytes]
+
+        # tracing turned on for sampled calls (rather than by start)
+        # and the no. of sampled calls running under it
+        self._owns_tracing = False
+        self._nsampling = 0
+
+        # gc pause times are available only on python 3.3+
+        self.gc_pauses = {} # generation -> [collections, total ms, max ms]
+        self._gc_start = None
+        if hasattr(gc, 'callbacks'): gc.callbacks.append(self._on_gc)
+
+    def _get_tracemalloc(self):
+        if tracemalloc is None:
+            raise RuntimeError('tracemalloc is not available')
+        return tracemalloc
+
+    @property
+    def is_tracing(self):
+        return tracemalloc is not None and tracemalloc.is_tracing()
+
+    def start(self, nframes=None):
+        self._get_tracemalloc().start(nframes or self.NFRAMES)
+
+        # sampled calls must not stop tracing started here
+        self._owns_tracing = False
+        self._nsampling = 0
+        return self.summary()
+
+    def stop(self):
+        self._get_tracemalloc().stop()
+        self._owns_tracing = False
+        self._nsampling = 0
+        self.last_snapshot = None
+        return self.summary()
+
+    def summary(self):
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        d = {
+            'maxrss': ru.ru_maxrss,
+            'gc_count': gc.get_count(),
+            'gc_threshold': gc.get_threshold(),
+            'gc_garbage': len(gc.garbage),
+            'tracing': self.is_tracing and not self._owns_tracing,
+        }
+
+        if d['tracing']:
+            current, peak = self._get_tracemalloc().get_traced_memory()
+            d.update(traced_current=current, traced_peak=peak)
+
+        return d
+
+    def top_types(self, limit=20):
+        '''
+        Counts of live objects tracked by the gc by type. This
+        walks all the objects so is meant for on-demand use.
+        '''
+        counts = Counter()
+        for ob in gc.get_objects():
+            t = type(ob)
+            counts['%s.%s' % (t.__module__, t.__name__)] += 1
+        return counts.most_common(limit)
+
+    def _take_snapshot(self):
+        tracemalloc = self._get_tracemalloc()
+        if not tracemalloc.is_tracing() or self._owns_tracing:
+            raise RuntimeError('tracemalloc is not tracing. start it first')
+
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+
+    def snapshot(self, limit=20):
+        '''
+        Takes a snapshot that later diffs are computed against
+        and returns the top allocation sites in it.
+        '''
+        self.last_snapshot = self._take_snapshot()
+        stats = self.last_snapshot.statistics('lineno')
+        return [str(x) for x in stats[:limit]]
+
+    def diff(self, limit=20):
+        '''
+        Returns the top allocation sites by growth since the
+        last snapshot. The new snapshot becomes the baseline.
+        '''
+        if self.last_snapshot is None:
+            return self.snapshot(limit)
+
+        snapshot = self._take_snapshot()
+        stats = snapshot.compare_to(self.last_snapshot, 'lineno')
+        self.last_snapshot = snapshot
+        return [str(x) for x in stats[:limit]]
+
+    def _on_gc(self, phase, info):
+        if phase == 'start':
+            self._gc_start = time.time()
+            return
+
+        if self._gc_start is None: return
+        ms = (time.time() - self._gc_start) * 1000
+        self._gc_start = None
+
+        p = self.gc_pauses.setdefault(info['generation'], [0, 0.0, 0.0])
+        p[0] += 1
+        p[1] += ms
+        p[2] = max(p[2], ms)
+
+    def gc_stats(self):
+        d = {
+            'count': gc.get_count(),
+            'threshold': gc.get_threshold(),
+            'garbage': len(gc.garbage),
+            'pauses': dict((gen, {'collections': n, 'total_ms': total, 'max_ms': _max})
+                for gen, (n, total, _max) in self.gc_pauses.iteritems()),
+        }
+        if hasattr(gc, 'get_stats'): d['stats'] = gc.get_stats()
+        return d
+
+    def collect(self):
+        '''
+        Runs a full collection and reports how long it took
+        '''
+        t = time.time()
+        n = gc.collect()
+        return {'collected': n, 'ms': (time.time() - t) * 1000}
+
+    def sample_start(self):
+        '''
+        Called before an API fn is executed. Returns the traced
+        memory if this call is sampled and None otherwise.
+        '''
+        if tracemalloc is None: return None
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.NFRAMES)
+            self._owns_tracing = True
+        if self._owns_tracing: self._nsampling += 1
+
+        return tracemalloc.get_traced_memory()[0]
+
+    def sample_end(self, fn_name, start):
+        if start is None: return
+
+        if tracemalloc.is_tracing():
+            nbytes = tracemalloc.get_traced_memory()[0] - start
+            a = self.fn_allocs.setdefault(fn_name, [0, 0, 0])
+            a[0] += 1
+            a[1] += nbytes
+            a[2] = max(a[2], nbytes)
+
+        if self._owns_tracing and self._nsampling > 0:
+            self._nsampling -= 1
+            if not self._nsampling:
+                tracemalloc.stop()
+                self._owns_tracing = False
+
+    def functions(self, limit=20):
+        '''
+        API fns by the net memory allocated by their sampled calls
+        '''
+        fns = sorted(self.fn_allocs.iteritems(), key=lambda x: x[1][1], reverse=True)
+        return [{'fn': fn, 'samples': n, 'total_bytes': total, 'max_bytes': _max,
+                    'avg_bytes': total / n}
+                    for fn, (n, total, _max) in fns[:limit]]
+
+class LoopMonitor(object):
+    '''
+    Watches the health of the event loop. A greenlet wakes up
+    every INTERVAL seconds and measures how late it was (loop
+    lag) and the no. of pending loop callbacks (greenlets that
+    are ready to run and other queued callbacks). A watchdog
+    thread notices when the loop has not run for more than
+    @block_threshold seconds and captures the stack of the code
+    holding it, along with the API fn being executed if any.
+
+    Blocking incidents are logged once the loop is free again
+    and the recent ones are kept in self.slow_callbacks.
+    '''
+
+    INTERVAL = 0.1 # seconds
+    BLOCK_THRESHOLD = 0.5 # seconds
+    MAX_SLOW_CALLBACKS = 100
+
+    def __init__(self, stats, log, block_threshold=None):
+        self.stats = stats
+        self.log = log
+        self.block_threshold = block_threshold or self.BLOCK_THRESHOLD
+
+        self.lag = 0.0 # ms
+        self.pending = 0
+        self.slow_callbacks = deque(maxlen=self.MAX_SLOW_CALLBACKS)
+
+        # incidents captured by the watchdog thread and
+        # logged from the loop (logging is not thread safe
+        # under monkey patching)
+        self._reports = deque()
+
+        self.thread_ident = get_thread_ident()
+        self.last_tick = None
+        self.running = False
+        self.ticker = None
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        self.last_tick = time.time()
+        self.ticker = gevent.spawn(self._tick)
+        get_original('thread', 'start_new_thread')(self._watch, ())
+
+    def stop(self):
+        self.running = False
+        if self.ticker is not None: self.ticker.kill(block=False)
+
+    def _tick(self):
+        while self.running:
+            t = time.time()
+            gevent.sleep(self.INTERVAL)
+            now = self.last_tick = time.time()
+
+            self.lag = max(0.0, (now - t - self.INTERVAL) * 1000)
+            # callbacks queued on the hub, which is where greenlets
+            # ready to run wait (libev's pendingcnt counts watchers)
+            self.pending = len(gevent.get_hub().loop._callbacks)
+            self.stats.timing('loop.lag', self.lag)
+            self.stats.gauge('loop.pending', self.pending)
+
+            while self._reports:
+                self._log_report(self._reports.popleft(), now)
+
+    def _watch(self):
+        sleep = get_original('time', 'sleep')
+        reported_tick = None
+
+        while self.running:
+            sleep(self.block_threshold / 2)
+
+            tick = self.last_tick
+            if tick == reported_tick: continue
+            if time.time() - tick - self.INTERVAL < self.block_threshold: continue
+
+            frame = sys._current_frames().get(self.thread_ident)
+            if frame is None: continue
+
+            reported_tick = tick
+            self._reports.append({
+                'start': tick + self.INTERVAL,
+                'fn': self._find_api_fn(frame),
+                'stack': ''.join(traceback.format_stack(frame)),
+            })
+
+    def _find_api_fn(self, frame):
+        while frame is not None:
+            if frame.f_code.co_name == '_execute_single_call':
+                return frame.f_locals.get('fn_name')
+            frame = frame.f_back
+        return None
+
+    def _log_report(self, report, now):
+        report['duration'] = (now - report['start']) * 1000
+        self.slow_callbacks.append(report)
+
+        self.stats.incr('loop.blocked')
+        if report['fn']: self.stats.incr('api.%s.blocked' % report['fn'])
+
+        self.log.warning('Event loop blocked for %dms. fn=%s, stack:\n%s' % \
+            (report['duration'], report['fn'], report['stack']))
+
+class MemoryHandler(BaseHandler):
+    '''
+    HTTP access to MemoryDiagnostics. Actions that change state
+    are only allowed over POST.
+    '''
+
+    GET_ACTIONS = ('summary', 'top_types', 'gc_stats', 'functions')
+    POST_ACTIONS = ('start', 'stop', 'snapshot', 'diff', 'collect')
+
+    def initialize(self, server):
+        self.memory = server.memory
+
+    def _do(self, action, allowed):
+        if action not in allowed: raise HTTPError(404)
+
+        fn = getattr(self.memory, action)
+        kwargs = {}
+        if 'limit' in inspect.getargspec(fn).args:
+            kwargs['limit'] = int(self.get_argument('limit', 20))
+
+        try:
+            r = fn(**kwargs)
+        except RuntimeError, e:
+            self.set_status(400)
+            r = {'error': str(e)}
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(r))
+
+    def get(self, action):
+        self._do(action, self.GET_ACTIONS)
+
+    def post(self, action):
+        self._do(action, self.POST_ACTIONS)
+
 class BaseScript(object):
     LOG_FORMATTER = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
     DESC = 'Base script abstraction'
@@ -361,17 +1176,16 @@ class BaseScript(object):
 
         log = logging.getLogger('')
 
-        stderr_hdlr = logging.StreamHandler(sys.stderr)
         rofile_hdlr = logging.handlers.RotatingFileHandler(fname,
             maxBytes=MAX_LOG_FILE_SIZE, backupCount=10)
-        hdlrs = (stderr_hdlr, rofile_hdlr)
+        hdlrs = [rofile_hdlr]
+        if not quiet: hdlrs.append(logging.StreamHandler(sys.stderr))
 
         for hdlr in hdlrs:
             hdlr.setFormatter(self.LOG_FORMATTER)
-            log.addHandler(hdlr)
 
-        log.addHandler(rofile_hdlr)
-        if not quiet: log.addHandler(stderr_hdlr)
+        # writing to file and stderr is done in the background
+        log.addHandler(AsyncLogHandler(hdlrs))
 
         log.setLevel(getattr(logging, log_level.upper()))
 
@@ -442,9 +1256,14 @@ class FuncServer(BaseScript):
 
     APP_CLASS = tornado.web.Application
 
+    # no. of threads evaluating python console commands
+    CONSOLE_THREADS = 4
+
     def __init__(self):
         super(FuncServer, self).__init__()
         self.log_id = 0
+        self.thread_ident = get_thread_ident()
+        self.console_pool = gevent.threadpool.ThreadPool(self.CONSOLE_THREADS)
 
         # add weblog handler to logger
         weblog_hdlr = WebLogHandler(self)
@@ -465,7 +1284,7 @@ class FuncServer(BaseScript):
 
         self.static_handler_class = shclass
 
-        self.nav_tabs = [('Console', '/console'), ('Logs', '/logs')]
+        self.nav_tabs = [('Console', '/console'), ('Logs', '/logs'), ('Memory', '/memory')]
         self.nav_tabs = self.prepare_nav_tabs(self.nav_tabs)
 
         settings = {
@@ -484,6 +1303,16 @@ class FuncServer(BaseScript):
         # all active websockets and their state
         self.websocks = {}
 
+        self.loop_monitor = LoopMonitor(self.stats, self.log,
+            self.args.loop_block_threshold)
+
+        self.memory = MemoryDiagnostics(self.args.memory_sample_rate)
+        if self.args.trace_memory:
+            try:
+                self.memory.start()
+            except RuntimeError, e:
+                self.log.warning('cannot trace memory: %s' % e)
+
     @property
     def name(self):
         return '.'.join([x for x in (self.NAME, self.args.name) if x])
@@ -492,6 +1321,15 @@ class FuncServer(BaseScript):
         super(FuncServer, self).define_baseargs(parser)
         parser.add_argument('--port', default=self.DEFAULT_PORT,
             type=int, help='port to listen on for server')
+        parser.add_argument('--trace-memory', action='store_true',
+            help='Trace memory allocations from startup (needs tracemalloc)')
+        parser.add_argument('--memory-sample-rate', type=float,
+            default=MemoryDiagnostics.SAMPLE_RATE,
+            help='Fraction of API calls whose allocations are measured')
+        parser.add_argument('--loop-block-threshold', type=float,
+            default=LoopMonitor.BLOCK_THRESHOLD,
+            help='Seconds the event loop can be held before the '
+                'blocking stack is captured and logged')
 
     def _send_log(self, msg):
         msg = {'type': MSG_TYPE_LOG, 'id': self.log_id, 'data': msg}
@@ -511,7 +1349,10 @@ class FuncServer(BaseScript):
 
         return [
             (r'/ws', WSConnection),
+            (r'/ping', PingHandler),
             (r'/logs', make_handler('logs.html', BaseHandler)),
+            (r'/memory', make_handler('memory.html', BaseHandler)),
+            (r'/memory/([a-z_]+)', MemoryHandler, dict(server=self)),
             (r'/console', make_handler('console.html', BaseHandler)),
             (r'/', make_handler('console.html', BaseHandler))
         ]
@@ -551,18 +1392,123 @@ class FuncServer(BaseScript):
 
     def start(self):
         self.pre_start()
+        self.loop_monitor.start()
         if self.args.port != 0:
             self.app.listen(self.args.port)
         tornado.ioloop.IOLoop.instance().start()
 
+class SingleFlight(object):
+    '''
+    An in-progress execution of a singleflight fn that
+    concurrent identical calls wait on.
+    '''
+    def __init__(self):
+        self.result = gevent.event.AsyncResult()
+        self.serialized = {} # protocol -> serialized result
+
+class HTTPCacheEntry(object):
+    '''
+    Validators of the last response sent for a cacheable GET call
+    '''
+    def __init__(self, etag, last_modified, expires):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = expires
+
+class APISchemaMismatch(Exception):
+    pass
+
+class APISchema(object):
+    '''
+    Numeric ids and positional argument layouts of the API fns
+    used by the compact call encoding. A compact call is the
+    msgpack encoded [version, fn id, args] and its result is
+    [success, result], so neither field names nor fn names are
+    sent on the wire.
+
+    Ids follow the sorted order of the public fns of the API
+    object. @version changes whenever the fns or their arguments
+    change so that a client with a stale schema is detected.
+    '''
+
+    def __init__(self, fns, version=None):
+        self.fns = fns # [(name, argnames), ...] in id order
+        self.ids = dict((name, (i, args)) for i, (name, args) in enumerate(fns))
+        self.version = version or hashlib.sha1(msgpack.packb(fns)).hexdigest()[:8]
+
+    @classmethod
+    def from_api(cls, api):
+        fns = []
+        for name in sorted(dir(api)):
+            if name.startswith('_'): continue
+
+            fn = getattr(api, name, None)
+            if not callable(fn) or 'raw' in get_fn_tags(fn): continue
+
+            try:
+                spec = inspect.getargspec(fn)
+            except TypeError:
+                continue
+
+            args = spec.args[1:] if inspect.ismethod(fn) else spec.args
+            fns.append((name, args))
+
+        return cls(fns)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls([(name, args) for name, args in d['fns']], d['version'])
+
+    def to_dict(self):
+        return {'version': self.version, 'fns': self.fns}
+
+    def encode_call(self, fn, args, kwargs):
+        '''
+        Returns the compact frame for the call or None if the
+        call cannot be expressed positionally by this schema.
+        '''
+        x = self.ids.get(fn)
+        if x is None: return None
+        fn_id, argnames = x
+
+        args = list(args)
+        if kwargs:
+            # kwargs must fill the positions right after args
+            names = argnames[len(args):len(args) + len(kwargs)]
+            if set(names) != set(kwargs): return None
+            args.extend(kwargs[n] for n in names)
+
+        return msgpack.packb([self.version, fn_id, args])
+
+    def decode_call(self, data):
+        version, fn_id, args = msgpack.unpackb(data)
+        if version != self.version or not 0 <= fn_id < len(self.fns):
+            raise APISchemaMismatch(version)
+        return self.fns[fn_id][0], args
+
+    @staticmethod
+    def encode_result(r):
+        return msgpack.packb([r['success'], r['result']])
+
+    @staticmethod
+    def decode_result(data):
+        return msgpack.unpackb(data)
+
 class RPCHandler(BaseHandler):
     WRITE_CHUNK_SIZE = 4096
+    MAX_HTTP_CACHE_ENTRIES = 10000
+
+    # first chars of query arg values that may be json
+    # (true, false and null are checked for separately)
+    JSON_START_CHARS = frozenset('{["-0123456789')
+    JSON_CONSTANTS = {'true': True, 'false': False, 'null': None}
 
     def initialize(self, server):
         self.server = server
         self.stats = server.stats
         self.log = server.log
         self.api = server.api
+        self.flight = None
 
     def _get_apifn(self, fn_name):
         obj = self.api
@@ -588,10 +1534,60 @@ class RPCHandler(BaseHandler):
 
         return kwargs
 
+    def _singleflight_key(self, m):
+        try:
+            fn = self._get_apifn(m['fn'])
+        except Exception:
+            return None
+
+        if 'singleflight' not in get_fn_tags(fn):
+            return None
+
+        # lists and tuples pack identically and kwargs are
+        # sorted so that equivalent calls get the same key
+        try:
+            return (m['fn'], msgpack.packb(m.get('args', [])),
+                msgpack.packb(sorted(m.get('kwargs', {}).iteritems())))
+        except (TypeError, ValueError):
+            return None
+
     def _handle_single_call(self, m):
+        key = self._singleflight_key(m)
+        if key is None:
+            return self._execute_single_call(m)
+
+        inflight = self.server.inflight
+        flight = inflight.get(key)
+        if flight is not None:
+            self.stats.incr('api.%s.shared' % m['fn'])
+            self.flight = flight
+            return flight.result.get()
+
+        flight = inflight[key] = SingleFlight()
+        try:
+            r = self._execute_single_call(m)
+            flight.result.set(r)
+        except Exception, e:
+            flight.result.set_exception(e)
+            raise
+        except BaseException, e:
+            # GreenletExit (eg: a killed stream worker) must not be
+            # raised in the greenlets of other requests as they would
+            # exit without finishing. waiters get a failed result
+            flight.result.set({'success': False, 'result': repr(e)})
+            raise
+        finally:
+            inflight.pop(key, None)
+
+        self.flight = flight
+        return r
+
+    def _execute_single_call(self, m):
         fn_name = m.get('fn', None)
         sname = 'api.%s' % fn_name
         t = time.time()
+        sample = self.server.memory.sample_start()
+        fn = None
 
         try:
             fn = self._get_apifn(fn_name)
@@ -602,12 +1598,16 @@ class RPCHandler(BaseHandler):
         except Exception, e:
             self.log.exception('Exception during RPC call. '
                 'fn=%s, args=%s, kwargs=%s' % \
-                (m.get('fn', ''), repr(m.get('args', '[]')),
-                    repr(m.get('kwargs', '{}'))))
+                (m.get('fn', ''), LOG_REPR.repr(m.get('args', '[]')),
+                    LOG_REPR.repr(m.get('kwargs', '{}'))),
+                # names of unknown fns come from clients and share one
+                # rate limit bucket (see AsyncLogHandler)
+                extra={'rpc_fn': fn_name if fn is not None else '<unknown>'})
             r = {'success': False, 'result': repr(e)}
         finally:
             tdiff = (time.time() - t) * 1000
             self.stats.timing(sname, tdiff)
+            self.server.memory.sample_end(fn_name, sample)
 
         return r
 
@@ -622,10 +1622,34 @@ class RPCHandler(BaseHandler):
                     _r = _r['result'] if _r['success'] else None
                 r.append(_r)
 
+        # __batch__ and unknown fns (whose error is already
+        # in the result) have no fn object
+        try:
+            fnobj = self._get_apifn(fn)
+        except AttributeError:
+            fnobj = None
+
+        r = self._serialize(fn, fnobj, r, protocol)
+        self._write_response(fnobj, r, protocol)
 
-        fnobj = self._get_apifn(fn)
-        if 'raw' not in get_fn_tags(fnobj):
-            r = self.get_serializer(protocol)(r)
+    def _serialize(self, fn, fnobj, r, protocol):
+        if 'raw' in get_fn_tags(fnobj):
+            return r
+
+        # calls sharing a single flight share the
+        # serialized result too when protocols match
+        flight = self.flight if fn != '__batch__' else None
+        if flight is not None and protocol in flight.serialized:
+            return flight.serialized[protocol]
+
+        r = self.get_serializer(protocol)(r)
+        if flight is not None: flight.serialized[protocol] = r
+        return r
+
+    def _write_response(self, fnobj, r, protocol):
+        # let the client know that it can safely retry this fn
+        if 'idempotent' in get_fn_tags(fnobj):
+            self.set_header('X-RPC-Idempotent', '1')
 
         mime = getattr(fnobj, 'mime', self.get_mime(protocol))
         self.set_header('Content-Type', mime)
@@ -637,6 +1661,72 @@ class RPCHandler(BaseHandler):
             self.flush()
         self.finish()
 
+    def _handle_cacheable_call(self, fn, fnobj, m, protocol):
+        '''
+        Handles a GET call to a cacheable fn. Sets the caching
+        headers and responds with 304 Not Modified when the
+        client's copy is current. Until the response expires,
+        a conditional request is answered without executing
+        the fn or serializing the result.
+        '''
+        cache = self.server.http_cache
+        key = (protocol, fn, tuple(sorted((k, tuple(v))
+                for k, v in self.request.arguments.iteritems())))
+
+        entry = cache.get(key)
+        now = time.time()
+        if entry is not None and entry.expires > now and self._is_not_modified(entry):
+            self._set_cache_headers(fnobj, entry)
+            self.set_status(304)
+            self.finish()
+            return
+
+        r = self._handle_single_call(m)
+        failed = isinstance(r, dict) and r.get('success') is False
+        r = self._serialize(fn, fnobj, r, protocol)
+
+        if failed:
+            cache.pop(key, None)
+            self.set_header('Cache-Control', 'no-cache')
+            self._write_response(fnobj, r, protocol)
+            return
+
+        etag = '"%s"' % hashlib.sha1(r).hexdigest()
+        last_modified = int(now)
+        if entry is not None and entry.etag == etag:
+            last_modified = entry.last_modified
+
+        if len(cache) >= self.MAX_HTTP_CACHE_ENTRIES: cache.clear()
+        entry = cache[key] = HTTPCacheEntry(etag, last_modified,
+                                    now + fnobj.cache_max_age)
+
+        self._set_cache_headers(fnobj, entry)
+        if self._is_not_modified(entry):
+            self.set_status(304)
+            self.finish()
+            return
+
+        self._write_response(fnobj, r, protocol)
+
+    def _set_cache_headers(self, fnobj, entry):
+        self.set_header('ETag', entry.etag)
+        self.set_header('Last-Modified',
+            datetime.datetime.utcfromtimestamp(entry.last_modified))
+        self.set_header('Cache-Control', 'public, max-age=%d' % fnobj.cache_max_age)
+
+    def _is_not_modified(self, entry):
+        inm = self.request.headers.get('If-None-Match')
+        if inm is not None:
+            etags = [x.strip() for x in inm.split(',')]
+            return '*' in etags or entry.etag in etags
+
+        ims = self.request.headers.get('If-Modified-Since')
+        if ims is not None:
+            t = email.utils.parsedate_tz(ims)
+            return t is not None and entry.last_modified <= email.utils.mktime_tz(t)
+
+        return False
+
     def get_serializer(self, name):
         return {'msgpack': msgpack.packb,
                 'json': json.dumps,
@@ -660,18 +1750,257 @@ class RPCHandler(BaseHandler):
         gevent.spawn(lambda: self._handle_call(fn, m, protocol))
 
     def failsafe_json_decode(self, v):
+        if v in self.JSON_CONSTANTS:
+            return self.JSON_CONSTANTS[v]
+
+        # most plain strings can be told apart from json by
+        # the first char without paying for a failed decode
+        if not v or v[0] not in self.JSON_START_CHARS:
+            return v
+
         try: v = json.loads(v)
         except ValueError: pass
         return v
 
+    def _decode_bool(self, v):
+        return v.lower() in ('1', 'true', 'yes', 'on')
+
+    def _decode_int(self, v):
+        try: return int(v)
+        except ValueError: return self.failsafe_json_decode(v)
+
+    def _decode_float(self, v):
+        try: return float(v)
+        except ValueError: return self.failsafe_json_decode(v)
+
+    def _decode_str(self, v):
+        return v
+
+    def _get_arg_decoders(self, fn_name, fn):
+        '''
+        Returns a map of argument name to the decoder for its
+        query string value. The type of an argument is inferred
+        from its default value in the fn's signature. Arguments
+        without a default of a simple type are json decoded.
+        '''
+        decoders = self.server.arg_decoders.get(fn_name)
+        if decoders is not None: return decoders
+
+        # bool must be checked before int as it is a subclass
+        types = ((bool, self._decode_bool), (int, self._decode_int),
+            (long, self._decode_int), (float, self._decode_float),
+            (basestring, self._decode_str))
+
+        decoders = {}
+        try:
+            spec = inspect.getargspec(fn)
+        except TypeError:
+            spec = None
+
+        if spec is not None and spec.defaults:
+            names = spec.args[-len(spec.defaults):]
+            for name, default in zip(names, spec.defaults):
+                for _type, decoder in types:
+                    if isinstance(default, _type):
+                        decoders[name] = decoder
+                        break
+
+        self.server.arg_decoders[fn_name] = decoders
+        return decoders
+
     @tornado.web.asynchronous
     def get(self, protocol='default'):
+        args = dict([(k, v[0]) for k, v in self.request.arguments.iteritems()])
+        fn = args.pop('fn')
+
+        try:
+            fnobj = self._get_apifn(fn)
+        except AttributeError:
+            fnobj = None
+
+        decoders = self._get_arg_decoders(fn, fnobj) if fnobj is not None else {}
         D = self.failsafe_json_decode
-        args = dict([(k, D(v[0])) for k, v in self.request.arguments.iteritems()])
+        args = dict([(k, decoders.get(k, D)(v)) for k, v in args.iteritems()])
 
-        fn = args.pop('fn')
         m = dict(kwargs=args, fn=fn, args=[])
-        gevent.spawn(lambda: self._handle_call(fn, m, protocol))
+        if fnobj is not None and 'cacheable' in get_fn_tags(fnobj):
+            gevent.spawn(lambda: self._handle_cacheable_call(fn, fnobj, m, protocol))
+        else:
+            gevent.spawn(lambda: self._handle_call(fn, m, protocol))
+
+@tornado.web.stream_request_body
+class RPCStreamHandler(RPCHandler):
+    '''
+    Streamed batch calls. The request body is a stream of msgpack
+    encoded calls (dict(fn=.., args=.., kwargs=..)) one after the
+    other. Calls are executed as soon as they are parsed and the
+    response is a stream of msgpack encoded [index, success, result]
+    frames written as each call completes. Upto CONCURRENCY calls
+    are executed at a time, so frames can be out of order.
+
+    Reading of the request body is paused while MAX_QUEUED calls
+    are waiting and workers wait for each flush of the response
+    to complete, so memory use does not grow with the batch size
+    on either side.
+    '''
+
+    CONCURRENCY = 8
+    MAX_QUEUED = 1000
+    FLUSH_SIZE = 64 * 1024
+
+    def prepare(self):
+        self.unpacker = msgpack.Unpacker()
+        self.queue = gevent.queue.Queue(self.MAX_QUEUED)
+        self.ncalls = 0
+        self.unflushed = 0
+        self.flushing = None # gevent Event while a flush is pending
+
+        # started on the first call received (see data_received)
+        self.workers = []
+        self.enqueuer = None
+        self.closed = False
+
+        self.set_header('Content-Type', self.get_mime('msgpack'))
+
+    def get(self):
+        raise HTTPError(405)
+
+    def data_received(self, chunk):
+        if not self.workers:
+            self.workers = [gevent.spawn(self._work) for i in xrange(self.CONCURRENCY)]
+
+        self.unpacker.feed(chunk)
+
+        calls = []
+        for call in self.unpacker:
+            calls.append((self.ncalls, call))
+            self.ncalls += 1
+
+        if not calls: return
+
+        # returning a future makes tornado wait for it before
+        # reading more of the body (flow control)
+        future = tornado.concurrent.Future()
+        ioloop = tornado.ioloop.IOLoop.instance()
+
+        def enqueue():
+            for c in calls: self.queue.put(c)
+            ioloop.add_callback(future.set_result, None)
+
+        self.enqueuer = gevent.spawn(enqueue)
+        return future
+
+    def _work(self):
+        while 1:
+            item = self.queue.get()
+            if item is StopIteration: break
+
+            index, call = item
+
+            # any valid msgpack can arrive here. a worker must write
+            # a frame for every call as a dead worker stalls the stream
+            if not isinstance(call, dict) or 'fn' not in call:
+                frame = [index, False, 'invalid call. expected a map with fn']
+            else:
+                r = self._handle_single_call(call)
+                if isinstance(r, dict) and 'success' in r:
+                    frame = [index, r['success'], r['result']]
+                else:
+                    frame = [index, True, r]
+
+            try:
+                frame = msgpack.packb(frame)
+            except (TypeError, ValueError), e:
+                frame = msgpack.packb([index, False, repr(e)])
+
+            self._write_frame(frame)
+
+    def _write_frame(self, frame):
+        # do not add to the output while it is being flushed
+        while self.flushing is not None: self.flushing.wait()
+
+        self.write(frame)
+        self.unflushed += len(frame)
+        if self.unflushed < self.FLUSH_SIZE: return
+
+        # wait till the client has taken the data so that results
+        # do not pile up in the write buffer of a slow client
+        self.unflushed = 0
+        flushing = self.flushing = gevent.event.Event()
+        self.flush().add_done_callback(lambda f: flushing.set())
+        flushing.wait()
+        self.flushing = None
+
+    def _finish_stream(self):
+        for w in self.workers: self.queue.put(StopIteration)
+        gevent.joinall(self.workers)
+        if not self.closed: self.finish()
+
+    @tornado.web.asynchronous
+    def post(self):
+        gevent.spawn(self._finish_stream)
+
+    def _stop_workers(self):
+        if not hasattr(self, 'queue'): return # prepare not done
+
+        greenlets = self.workers + [self.enqueuer] if self.enqueuer else self.workers
+        gevent.killall(greenlets, block=False)
+        self.workers = []
+        self.enqueuer = None
+
+        while not self.queue.empty(): self.queue.get_nowait()
+
+    def on_connection_close(self):
+        # client went away in the middle of the stream
+        self.closed = True
+        self._stop_workers()
+        super(RPCStreamHandler, self).on_connection_close()
+
+    def on_finish(self):
+        self._stop_workers()
+
+class RPCCompactHandler(RPCHandler):
+    '''
+    Compact schema based calls (see APISchema). A GET returns
+    the schema and a POST executes a compact call. A call made
+    with a stale schema gets a 409 response.
+    '''
+
+    def get(self):
+        self.set_header('Content-Type', self.get_mime('msgpack'))
+        self.finish(msgpack.packb(self.server.get_schema().to_dict()))
+
+    @tornado.web.asynchronous
+    def post(self):
+        try:
+            fn, args = self.server.get_schema().decode_call(self.request.body)
+        except APISchemaMismatch:
+            self.set_status(409)
+            self.finish()
+            return
+
+        gevent.spawn(self._handle_compact_call, fn, args)
+
+    def _handle_compact_call(self, fn, args):
+        r = self._handle_single_call(dict(fn=fn, args=args, kwargs={}))
+        r = APISchema.encode_result(r)
+        self._write_response(self._get_apifn(fn), r, 'msgpack')
+
+class ReloadHandler(BaseHandler):
+    '''
+    Triggers a reload of the API object (see RPCServer.reload_api)
+    '''
+    def initialize(self, server):
+        self.server = server
+
+    def _reload(self):
+        r = self.server.reload_api()
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps({'success': r}))
+
+    @tornado.web.asynchronous
+    def post(self):
+        gevent.spawn(self._reload)
 
 class RPCServer(FuncServer):
     NAME = 'RPCServer'
@@ -683,15 +2012,230 @@ class RPCServer(FuncServer):
 
     IGNORE_UNEXPECTED_KWARGS = False
 
+    # names of modules to re-import on API reload in addition
+    # to the modules defining the API object's class hierarchy
+    RELOAD_MODULES = []
+    RELOAD_CHECK_INTERVAL = 2 # seconds
+
     def __init__(self, *args, **kwargs):
         super(RPCServer, self).__init__(*args, **kwargs)
         self.api = None
 
+        # source file mtimes of the API modules by module name
+        self.module_mtimes = {}
+
+        # built on first use (see get_schema)
+        self.schema = None
+
+        # in-progress singleflight executions by call key
+        self.inflight = {}
+
+        # GET query arg decoders by fn name (see RPCHandler)
+        self.arg_decoders = {}
+
+        # validators of cacheable GET responses by request
+        self.http_cache = {}
+
+    def define_baseargs(self, parser):
+        super(RPCServer, self).define_baseargs(parser)
+        parser.add_argument('--reload-on-change', action='store_true',
+            help='Reload the API when the source of its modules changes')
+
     def pre_start(self):
         self.api = self.prepare_api()
         if not hasattr(self.api, 'log'): self.api.log = self.log
+        self._snapshot_module_mtimes()
+
+        signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+        signal_handler(signal.SIGHUP, self.reload_api)
+        if self.args.reload_on_change: gevent.spawn(self._watch_api_modules)
+
         super(RPCServer, self).pre_start()
 
+    def get_schema(self):
+        if self.schema is None:
+            self.schema = APISchema.from_api(self.api)
+        return self.schema
+
+    def _get_api_modules(self):
+        '''
+        Modules defining the class hierarchy of the API object and
+        those named in RELOAD_MODULES. The module of the server
+        class is handled by _reload_server_class.
+        '''
+        skip = ('__main__', '__builtin__', __name__, type(self).__module__)
+
+        mods = {}
+        for cls in inspect.getmro(type(self.api)):
+            if cls.__module__ in skip: continue
+            m = sys.modules.get(cls.__module__)
+            if m is not None: mods[m.__name__] = m
+
+        for name in self.RELOAD_MODULES:
+            if name in sys.modules: mods[name] = sys.modules[name]
+
+        return mods.values()
+
+    def _get_server_module(self):
+        # funcserver itself is never reloaded
+        name = type(self).__module__
+        if name == __name__: return None
+
+        m = sys.modules.get(name)
+        if self._get_module_mtime(m) is None: return None
+        return m
+
+    def _get_watched_modules(self):
+        mods = self._get_api_modules()
+        m = self._get_server_module()
+        if m is not None: mods.append(m)
+        return mods
+
+    def _get_module_mtime(self, m):
+        fname = self._get_module_source(m)
+        if not fname: return None
+
+        try:
+            return os.path.getmtime(fname)
+        except OSError:
+            return None
+
+    def _get_module_source(self, m):
+        fname = getattr(m, '__file__', None)
+        if not fname: return None
+        if fname.endswith(('.pyc', '.pyo')): fname = fname[:-1]
+        return fname
+
+    def _snapshot_module_mtimes(self):
+        self.module_mtimes = dict((m.__name__, self._get_module_mtime(m))
+                                    for m in self._get_watched_modules())
+
+    def _get_changed_modules(self):
+        return [m for m in self._get_watched_modules()
+                if self._get_module_mtime(m) != self.module_mtimes.get(m.__name__)]
+
+    def _watch_api_modules(self):
+        while 1:
+            time.sleep(self.RELOAD_CHECK_INTERVAL)
+            if self._get_changed_modules(): self.reload_api()
+
+    def _reload_server_class(self, m):
+        '''
+        Re-imports @m, the module defining the server class, and
+        returns the server class from the new code.
+
+        The __main__ script cannot be re-imported. Its source is
+        executed again in a fresh namespace with a __name__ other
+        than '__main__' so that the `if __name__ == '__main__'`
+        block does not run again.
+        '''
+        name = type(self).__name__
+        if m.__name__ != '__main__':
+            return getattr(reload(m), name, None)
+
+        fname = self._get_module_source(m)
+        ns = dict(__name__='__reload_main__', __file__=fname,
+                    __builtins__=__builtins__)
+        execfile(fname, ns)
+        return ns.get(name)
+
+    def _rebind_names(self, m, reloaded):
+        '''
+        Points the classes and fns imported into @m from the
+        @reloaded modules (eg: `from mymod import API`) to their
+        reloaded versions.
+        '''
+        for name, obj in m.__dict__.items():
+            if not (inspect.isclass(obj) or inspect.isfunction(obj)): continue
+            if obj.__module__ not in reloaded: continue
+
+            new = getattr(sys.modules[obj.__module__], obj.__name__, None)
+            if new is not None: setattr(m, name, new)
+
+    def reload_api(self):
+        '''
+        Replaces the API object without restarting the server.
+        Modules of the API whose source has changed are re-imported
+        and prepare_api is called again. The new API object is
+        swapped in at once. Calls already in progress finish on
+        the old object while new calls go to the new one.
+
+        When the module of the server class (the script itself
+        when the server is defined in __main__) has changed, it is
+        re-imported too and the prepare_api of the new class is
+        called with the running server object. That prepare_api
+        cannot use super(MyServer, self) or methods added in the
+        new code as the server object is still of the old class.
+        Such a reload fails and needs a restart. When it has not
+        changed, names it imported from the reloaded modules are
+        bound again instead.
+
+        Triggered by SIGHUP, a POST to /reload, --reload-on-change
+        or by calling server.reload_api() from the console (which
+        runs it on the ioloop thread through call). If the reload
+        fails, the old API continues to be used.
+        '''
+        if get_thread_ident() != self.thread_ident:
+            return call(self.reload_api)
+
+        try:
+            api_modules = self._get_api_modules()
+            changed = set(m.__name__ for m in self._get_changed_modules())
+            reloaded = set()
+            for m in api_modules:
+                if m.__name__ not in changed: continue
+                self.log.info('reloading module %s' % m.__name__)
+                reload(m)
+                reloaded.add(m.__name__)
+
+            server_cls = None
+            server_module = self._get_server_module()
+            if server_module is None:
+                if not api_modules:
+                    self.log.warning('No reloadable module found for the API. '
+                        'prepare_api is run again with the code already loaded')
+            elif server_module.__name__ in changed:
+                self.log.info('reloading module %s' % server_module.__name__)
+                server_cls = self._reload_server_class(server_module)
+            else:
+                self._rebind_names(server_module, reloaded)
+
+            if not reloaded and server_cls is None:
+                self.log.info('no changed modules. running prepare_api again')
+
+            prepare_api = (server_cls or type(self)).prepare_api.im_func
+            api = prepare_api(self)
+            if not hasattr(api, 'log'): api.log = self.log
+            self.on_api_reload(self.api, api)
+        except Exception:
+            self.log.exception('API reload failed. Continuing with the old API')
+            return False
+        finally:
+            # a broken module is not retried till it is changed again
+            self._snapshot_module_mtimes()
+
+        self.api = api
+
+        # state derived from the old API
+        self.schema = None
+        self.inflight = {}
+        self.arg_decoders = {}
+        self.http_cache = {}
+
+        for ws in self.websocks.itervalues():
+            session = ws.get('console') if ws else None
+            if session is not None: session.interpreter.locals['api'] = api
+
+        self.log.warning('API reloaded')
+        return True
+
+    def on_api_reload(self, old_api, new_api):
+        '''
+        Override to carry over state (eg: caches, connection pools)
+        from the old API object to the new one during a reload
+        '''
+        pass
+
     def prepare_api(self):
         '''
         Prepare the API object that is exposed as
@@ -701,6 +2245,9 @@ class RPCServer(FuncServer):
 
     def prepare_base_handlers(self):
         hdlrs = super(RPCServer, self).prepare_base_handlers()
+        hdlrs.append((r'/reload', ReloadHandler, dict(server=self)))
+        hdlrs.append((r'/rpc/stream/?', RPCStreamHandler, dict(server=self)))
+        hdlrs.append((r'/rpc/compact/?', RPCCompactHandler, dict(server=self)))
         hdlrs.append((r'/rpc(?:/([^/]*)/?)?', RPCHandler, dict(server=self)))
         return hdlrs
 
@@ -709,6 +2256,207 @@ class RPCServer(FuncServer):
         ns['api'] = self.api
         return ns
 
+class RPCEndpoint(object):
+    '''
+    Client side view of a single RPCServer instance. Tracks
+    the state needed for load balancing and failover.
+    '''
+
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, url):
+        self.url = url
+        self.rpc_url = urlparse.urljoin(url, 'rpc')
+        self.stream_url = urlparse.urljoin(url, 'rpc/stream')
+        self.compact_url = urlparse.urljoin(url, 'rpc/compact')
+        self.ping_url = urlparse.urljoin(url, 'ping')
+
+        self.outstanding = 0
+        self.latency = 0.0 # EWMA of response time in ms
+        self.failures = 0 # consecutive failures
+        self.ejected = False
+
+    def update_latency(self, ms):
+        a = self.EWMA_ALPHA
+        self.latency = ms if not self.latency else a * ms + (1 - a) * self.latency
+
+    def __repr__(self):
+        return '<RPCEndpoint %s outstanding=%d latency=%.1fms ejected=%s>' % \
+            (self.url, self.outstanding, self.latency, self.ejected)
+
+class RPCEndpointPool(object):
+    '''
+    Set of RPCServer endpoints shared by an RPCClient and all
+    the child clients derived from it.
+
+    Endpoints are picked using one of the following policies:
+        roundrobin - cycle through the endpoints
+        least_outstanding - fewest requests currently in flight
+        ewma - lowest latency (EWMA) weighted by requests in flight
+
+    An endpoint that fails MAX_FAILURES times in a row is ejected
+    and is probed in the background until it responds again.
+
+    When @hedge_delay is set, idempotent calls that do not complete
+    within that many seconds are duplicated to another endpoint.
+    @hedge_delay can also be a percentile of observed latency
+    like 'p95'. No more than @hedge_budget fraction of calls is
+    hedged. Hedging metrics are available in self.metrics and are
+    also sent to @stats (a StatsCollector) when given.
+    '''
+
+    MAX_FAILURES = 3
+    PROBE_INTERVAL = 5 # seconds
+    PROBE_TIMEOUT = 2 # seconds
+
+    LATENCY_WINDOW = 1000 # no. of recent latencies to track
+    MIN_LATENCY_SAMPLES = 20
+    HEDGE_DELAY_REFRESH = 100 # recompute percentile every N samples
+
+    def __init__(self, urls, policy='roundrobin', idempotent=None,
+            hedge_delay=None, hedge_budget=0.05, stats=None):
+        if isinstance(urls, basestring): urls = [urls]
+        if not urls: raise ValueError('no server urls given')
+
+        self.endpoints = [RPCEndpoint(u) for u in urls]
+
+        policies = {'roundrobin': self._pick_roundrobin,
+                    'least_outstanding': self._pick_least_outstanding,
+                    'ewma': self._pick_ewma}
+        if policy not in policies:
+            raise ValueError('unknown load balancing policy: %s' % policy)
+        self.policy = policy
+        self._pick = policies[policy]
+        self._rr_index = 0
+
+        # names of fns that are safe to retry. learnt from
+        # server responses in addition to those given here.
+        self.idempotent = set(idempotent or [])
+
+        self.prober = None
+
+        self.hedge_delay = hedge_delay
+        self.hedge_budget = hedge_budget
+        self.latencies = deque(maxlen=self.LATENCY_WINDOW)
+        self._nsamples = 0
+        self._percentile_delay = None
+
+        self.stats = stats
+        self.metrics = {'hedge.eligible': 0, 'hedge.sent': 0, 'hedge.won': 0}
+
+        # APISchema for compact calls (see RPCClient)
+        self.schema = None
+        self.schema_fetched_at = 0
+
+    def pick(self, exclude=()):
+        candidates = [e for e in self.endpoints
+                        if not e.ejected and e not in exclude]
+
+        # when all the endpoints are ejected, try them anyway
+        # rather than failing without making any attempt
+        if not candidates:
+            candidates = [e for e in self.endpoints if e not in exclude]
+
+        if not candidates: return None
+        return self._pick(candidates)
+
+    def has_candidate(self, exclude=()):
+        return any(e not in exclude for e in self.endpoints)
+
+    def _pick_roundrobin(self, candidates):
+        e = candidates[self._rr_index % len(candidates)]
+        self._rr_index += 1
+        return e
+
+    def _pick_least_outstanding(self, candidates):
+        random.shuffle(candidates)
+        return min(candidates, key=lambda e: e.outstanding)
+
+    def _pick_ewma(self, candidates):
+        random.shuffle(candidates)
+        return min(candidates, key=lambda e: e.latency * (e.outstanding + 1))
+
+    def on_start(self, e):
+        e.outstanding += 1
+
+    def on_success(self, e, ms=None):
+        e.outstanding -= 1
+        e.failures = 0
+
+        # no timing for calls unlike the others (eg: streamed batches)
+        if ms is None: return
+        e.update_latency(ms)
+
+        self.latencies.append(ms)
+        self._nsamples += 1
+        if self._nsamples % self.HEDGE_DELAY_REFRESH == 0:
+            self._percentile_delay = None
+
+    def on_cancel(self, e):
+        e.outstanding -= 1
+
+    def on_failure(self, e):
+        e.outstanding -= 1
+        e.failures += 1
+
+        if e.failures >= self.MAX_FAILURES and not e.ejected:
+            e.ejected = True
+            logging.warning('RPC endpoint ejected: %s' % e.url)
+            self._start_prober()
+
+    def incr(self, key):
+        self.metrics[key] += 1
+        if self.stats is not None: self.stats.incr('rpcclient.' + key)
+
+    @property
+    def hedge_rate(self):
+        n = self.metrics['hedge.eligible']
+        return float(self.metrics['hedge.sent']) / n if n else 0.0
+
+    def get_hedge_delay(self):
+        '''
+        Returns the number of seconds to wait before sending
+        a hedged request or None if hedging is not to be done.
+        '''
+        d = self.hedge_delay
+        if d is None or len(self.endpoints) < 2: return None
+        if not isinstance(d, basestring): return d
+
+        if self._percentile_delay is None:
+            if len(self.latencies) < self.MIN_LATENCY_SAMPLES: return None
+            p = float(d.lstrip('p')) / 100
+            l = sorted(self.latencies)
+            idx = min(int(len(l) * p), len(l) - 1)
+            self._percentile_delay = l[idx] / 1000.0
+
+        return self._percentile_delay
+
+    def can_hedge(self):
+        m = self.metrics
+        return m['hedge.sent'] + 1 <= self.hedge_budget * m['hedge.eligible']
+
+    def _start_prober(self):
+        if self.prober is not None and not self.prober.dead: return
+        self.prober = gevent.spawn(self._probe)
+
+    def _probe(self):
+        while 1:
+            ejected = [e for e in self.endpoints if e.ejected]
+            if not ejected: break
+
+            time.sleep(self.PROBE_INTERVAL)
+
+            for e in ejected:
+                try:
+                    req = requests.get(e.ping_url, timeout=self.PROBE_TIMEOUT)
+                    if req.status_code != 200: continue
+                except requests.RequestException:
+                    continue
+
+                e.ejected = False
+                e.failures = 0
+                logging.warning('RPC endpoint reinstated: %s' % e.url)
+
 def _passthrough(name):
     def fn(self, *args, **kwargs):
         p = self.prefix + '.' + name
@@ -719,12 +2467,46 @@ def _passthrough(name):
     return fn
 
 class RPCClient(object):
+    '''
+    Client to call the API exposed by one or more RPCServer
+    instances. @server_url can be a single url or a list of
+    urls among which the calls are load balanced as per
+    @policy (see RPCEndpointPool).
+
+    A call that fails because of a network or server error is
+    retried on a different server (upto MAX_RETRIES times) only
+    if the fn is idempotent. The server tells the client which
+    fns are idempotent (@idempotent) and more can be listed in
+    @idempotent.
+
+    Idempotent calls can also be hedged by setting @hedge_delay
+    and @hedge_budget (see RPCEndpointPool).
+
+    With @compact, calls are sent in the compact encoding (see
+    APISchema) after fetching the schema from the server. Calls
+    that the schema cannot express, and all calls to servers
+    without schema support, use the regular encoding.
+    '''
+
     SERIALIZER = staticmethod(msgpack.packb)
     DESERIALIZER = staticmethod(msgpack.unpackb)
 
-    def __init__(self, server_url, prefix=None, parent=None):
+    MAX_RETRIES = 2
+    SCHEMA_FETCH_INTERVAL = 60 # seconds between failed schema fetches
+
+    STREAM_CHUNK_SIZE = 64 * 1024 # bytes of calls per request chunk
+    STREAM_READ_SIZE = 4096
+
+    def __init__(self, server_url, prefix=None, parent=None,
+            policy='roundrobin', idempotent=None, timeout=None,
+            hedge_delay=None, hedge_budget=0.05, stats=None,
+            compact=False, pool=None):
         self.server_url = server_url
-        self.rpc_url = urlparse.urljoin(server_url, 'rpc')
+        self.pool = pool or RPCEndpointPool(server_url, policy, idempotent,
+            hedge_delay, hedge_budget, stats)
+        self.rpc_url = self.pool.endpoints[0].rpc_url
+        self.timeout = timeout
+        self.compact = compact
         self.is_batch = False
         self.prefix = prefix
         self.parent = parent
@@ -734,7 +2516,8 @@ class RPCClient(object):
     def __getattr__(self, attr):
         prefix = self.prefix + '.' + attr if self.prefix else attr
         return self.__class__(self.server_url, prefix=prefix,
-                parent=self if self.bound else self.parent)
+                parent=self if self.bound else self.parent,
+                timeout=self.timeout, compact=self.compact, pool=self.pool)
 
     def get_handle(self):
         self.bound = True
@@ -766,9 +2549,119 @@ class RPCClient(object):
     def unset_batch(self):
         self.is_batch = False
 
+    def _post(self, data, retry=False, tried=None, url='rpc_url'):
+        '''
+        Posts @data to the @url (name of the RPCEndpoint url
+        attribute) of an endpoint picked from the pool and
+        returns the response. On failure, the request is sent
+        to a different endpoint if @retry is set. Endpoints
+        in @tried are avoided and the picked ones are added.
+        '''
+        if tried is None: tried = []
+
+        while 1:
+            # all endpoints may have been taken by a hedged request
+            e = self.pool.pick(exclude=tried)
+            if e is None: raise RPCCallException('no RPC endpoint left to try')
+            tried.append(e)
+
+            self.pool.on_start(e)
+            t = time.time()
+            try:
+                req = requests.post(getattr(e, url), data=data, timeout=self.timeout)
+                if req.status_code >= 500: req.raise_for_status()
+            except gevent.GreenletExit:
+                # cancelled as the hedged request won
+                self.pool.on_cancel(e)
+                raise
+            except requests.RequestException:
+                self.pool.on_failure(e)
+                if not retry or len(tried) > self.MAX_RETRIES or \
+                    len(tried) >= len(self.pool.endpoints):
+                    raise
+                continue
+
+            self.pool.on_success(e, (time.time() - t) * 1000)
+            return req
+
+    def _post_hedged(self, data, url='rpc_url'):
+        '''
+        Like _post but duplicates the request to another
+        endpoint if a response does not arrive in time. The
+        first successful response is returned and the other
+        request is cancelled.
+        '''
+        pool = self.pool
+        delay = pool.get_hedge_delay()
+        if delay is None: return self._post(data, retry=True, url=url)
+
+        pool.incr('hedge.eligible')
+        tried = []
+        first = gevent.spawn(self._post, data, True, tried, url)
+        first.join(timeout=delay)
+        if first.ready() or not pool.can_hedge() or \
+            not pool.has_candidate(exclude=tried):
+            return first.get()
+
+        pool.incr('hedge.sent')
+        second = gevent.spawn(self._post, data, True, tried, url)
+
+        pending = [first, second]
+        winner = None
+        while pending and winner is None:
+            for g in gevent.wait(pending, count=1):
+                pending.remove(g)
+                if g.successful(): winner = g; break
+        gevent.killall(pending, block=False)
+
+        if winner is None: return first.get() # raises first's error
+        if winner is second: pool.incr('hedge.won')
+        return winner.value
+
+    def _get_schema(self):
+        pool = self.pool
+        if pool.schema is not None: return pool.schema
+
+        # servers without schema support are not asked every call
+        if time.time() - pool.schema_fetched_at < self.SCHEMA_FETCH_INTERVAL:
+            return None
+        pool.schema_fetched_at = time.time()
+
+        try:
+            req = requests.get(pool.pick().compact_url, timeout=self.timeout)
+            req.raise_for_status()
+            pool.schema = APISchema.from_dict(self.DESERIALIZER(req.content))
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            pool.schema = None
+
+        return pool.schema
+
+    def _send(self, fn, data, url='rpc_url'):
+        if fn in self.pool.idempotent:
+            req = self._post_hedged(data, url=url)
+        else:
+            req = self._post(data, url=url)
+        if req.headers.get('X-RPC-Idempotent'): self.pool.idempotent.add(fn)
+        return req
+
     def _do_single_call(self, fn, args, kwargs):
+        schema = self._get_schema() if self.compact else None
+        frame = schema.encode_call(fn, args, kwargs) if schema else None
+
+        if frame is not None:
+            req = self._send(fn, frame, url='compact_url')
+            if req.status_code != 409:
+                success, result = APISchema.decode_result(req.content)
+                if not success: raise RPCCallException(result)
+                return result
+
+            # the server's API has changed. refetch the schema
+            # on the next call and use the regular encoding now
+            self.pool.schema = None
+            self.pool.schema_fetched_at = 0
+
         m = self.SERIALIZER(dict(fn=fn, args=args, kwargs=kwargs))
-        req = requests.post(self.rpc_url, data=m)
+        req = self._send(fn, m)
         res = self.DESERIALIZER(req.content)
 
         if not res['success']:
@@ -779,14 +2672,92 @@ class RPCClient(object):
     def execute(self):
         if not self._calls: return
 
+        retry = all(c['fn'] in self.pool.idempotent for c in self._calls)
         m = dict(fn='__batch__', calls=self._calls)
         m = self.SERIALIZER(m)
-        req = requests.post(self.rpc_url, data=m)
-        res = self.DESERIALIZER(req.content)
         self._calls = []
+        req = self._post(m, retry=retry)
+        res = self.DESERIALIZER(req.content)
 
         return res
 
+    def _send_stream(self, conn, calls):
+        '''
+        Sends @calls as the chunked body of the request on @conn
+        '''
+        S = self.SERIALIZER
+        buf, size = [], 0
+
+        for c in calls:
+            data = S(dict(fn=c['fn'], args=c.get('args', ()), kwargs=c.get('kwargs', {})))
+            buf.append(data)
+            size += len(data)
+            if size < self.STREAM_CHUNK_SIZE: continue
+
+            conn.send('%x\r\n%s\r\n' % (size, ''.join(buf)))
+            buf, size = [], 0
+
+        if buf: conn.send('%x\r\n%s\r\n' % (size, ''.join(buf)))
+        conn.send('0\r\n\r\n')
+
+    def execute_stream(self, calls=None):
+        '''
+        Executes @calls (an iterable of dict(fn=.., args=.., kwargs=..)
+        or the calls queued in batch mode) as a streamed batch. Calls
+        are sent as they are produced by the iterable and results are
+        yielded as (index, success, result) as soon as they arrive,
+        while the rest of the calls are still being sent. Results
+        need not be in the order of the calls.
+        '''
+        if calls is None:
+            calls, self._calls = self._calls, []
+
+        e = self.pool.pick()
+        u = urlparse.urlsplit(e.stream_url)
+        C = httplib.HTTPSConnection if u.scheme == 'https' else httplib.HTTPConnection
+        conn = C(u.netloc, timeout=self.timeout)
+        sender = None
+
+        # requests sends the whole body before reading the response
+        # so a raw connection is used. the body is sent by another
+        # greenlet while the response is read here.
+        self.pool.on_start(e)
+        try:
+            conn.putrequest('POST', u.path, skip_accept_encoding=True)
+            conn.putheader('Content-Type', 'application/x-msgpack')
+            conn.putheader('Transfer-Encoding', 'chunked')
+            conn.endheaders()
+
+            sender = gevent.spawn(self._send_stream, conn, calls)
+            res = conn.getresponse()
+            if res.status != 200:
+                raise RPCCallException('streamed batch failed: %s %s' % (res.status, res.reason))
+        except (socket.error, httplib.HTTPException, RPCCallException):
+            self.pool.on_failure(e)
+            if sender is not None: sender.kill(block=False)
+            conn.close()
+            raise
+
+        # the time taken by a whole batch would skew the latencies
+        # used for ewma picks and hedge delays of regular calls
+        self.pool.on_success(e)
+
+        try:
+            unpacker = msgpack.Unpacker()
+            while 1:
+                chunk = res.read(self.STREAM_READ_SIZE)
+                if not chunk: break
+
+                unpacker.feed(chunk)
+                for index, success, result in unpacker:
+                    yield index, success, result
+
+            # raises the error if sending failed
+            sender.get()
+        finally:
+            sender.kill(block=False)
+            conn.close()
+
 if __name__ == '__main__':
     funcserver = FuncServer()
     funcserver.start()